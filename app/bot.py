@@ -1,8 +1,18 @@
 import os
-from typing import Callable, Any, Dict, Awaitable
+import time
+import tempfile
+from bisect import bisect_left
+from collections import Counter
+from itertools import islice
+from typing import Callable, Any, Dict, Awaitable, Tuple
 
 from utils import calculate_requirements, get_food_info, create_progress_chart,\
-      setup_logging, log, ValueOutOfRangeError
+      setup_logging, log, preload_modules, render, aggregate_history, history_start,\
+      create_history_chart, iter_user_records, write_rows, EXPORT_FIELDS,\
+      ValueOutOfRangeError
+from storage import TTLMemoryStorage, archive_profiles, restore_profile,\
+      delete_archived_profile, archived_entries_size, iter_archived_entries, iter_archived_profiles
+from leaderboard import WindowedLeaderboard
 
 from aiogram import Bot
 from aiogram import Dispatcher
@@ -24,12 +34,45 @@ setup_logging()
 
 telegram_token = os.environ.get("ACTIVITY_BOT_TOKEN")
 calories_token = os.environ.get("CALORIES_TOKEN")
+# unfinished /set_profile and /log_workout data is dropped after this idle time
+fsm_ttl = int(os.environ.get("FSM_TTL_SECONDS", 60 * 60))
+# changed profiles are saved to the archive directory on every eviction run,
+# profiles of users inactive for this long are also removed from memory
+profile_ttl = int(os.environ.get("PROFILE_ARCHIVE_AFTER_SECONDS", 30 * 24 * 60 * 60))
+eviction_interval = int(os.environ.get("EVICTION_INTERVAL_SECONDS", 10 * 60))
+# command class -> (commands running at once, commands waiting for a slot)
+admission_limits = {'chart': (2, 10), 'food': (4, 20), 'export': (1, 5)}
+admission_commands = {'/check_progress': 'chart', '/history': 'chart',
+                      '/log_food': 'food', '/export': 'export'}
+# overloaded commands from this set run without the expensive part instead of being rejected
+degradable_commands = {'/check_progress'}
+admission_wait_timeout = 5
+admission_stats_interval = 60
 bot = Bot(token=telegram_token)
 
-dp = Dispatcher()
+storage = TTLMemoryStorage(ttl=fsm_ttl)
+dp = Dispatcher(storage=storage)
 router = Router()
 
 users = {}
+last_seen = {}
+# users already checked to have no saved profile, so their messages do not touch the disk
+users_without_profile = set()
+# users whose profile or entries changed since the last save, and their unsaved entries
+changed_users = set()
+pending_entries = {}
+# profile files are written by one save at a time
+save_lock = asyncio.Lock()
+# only entries of the longest window are kept in memory, the full log is in the archive
+history_days = (7, 30)
+# (user_id, days) -> (day, ts of the last entry, text, file_id of the sent chart)
+history_cache = {}
+# water is scored in percent of the daily goal, calories and time in kcal and minutes
+leaderboards = {'water': WindowedLeaderboard(),
+                'calories': WindowedLeaderboard(),
+                'time': WindowedLeaderboard()}
+leaderboard_names = {}
+background_tasks = set()
 
 
 class Form(StatesGroup):
@@ -65,7 +108,104 @@ class CounterMiddleware(BaseMiddleware):
 
         return await handler(event, data)
 
+class ActivityMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+
+        user_id = event.from_user.id
+        last_seen[user_id] = time.monotonic()
+
+        if user_id not in users and user_id not in users_without_profile:
+            user_data = await asyncio.to_thread(restore_profile, user_id,
+                                                history_start(max(history_days)))
+
+            if user_data is None:
+                users_without_profile.add(user_id)
+            else:
+                # another update of the same user may have restored it meanwhile
+                users.setdefault(user_id, user_data)
+                log('info', 'Profile restored for user {}', user_id)
+
+        return await handler(event, data)
+
+class AdmissionMiddleware(BaseMiddleware):
+    def __init__(self, limits: Dict[str, Tuple[int, int]], commands: Dict[str, str],
+                 degradable: set, wait_timeout: float) -> None:
+        self.commands = commands
+        self.degradable = degradable
+        self.wait_timeout = wait_timeout
+        self.semaphores = {name: asyncio.Semaphore(limit) for name, (limit, _) in limits.items()}
+        self.max_waiting = {name: max_waiting for name, (_, max_waiting) in limits.items()}
+        self.waiting = Counter()
+        self.stats = {name: Counter() for name in limits}
+
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message,
+        data: Dict[str, Any]
+    ) -> Any:
+
+        command = event.text.split()[0].split('@')[0] if event.text else None
+        command_class = self.commands.get(command)
+
+        if command_class is None:
+            return await handler(event, data)
+
+        semaphore = self.semaphores[command_class]
+        stats = self.stats[command_class]
+
+        if semaphore.locked() and self.waiting[command_class] >= self.max_waiting[command_class]:
+            return await self.shed(command, command_class, handler, event, data)
+
+        self.waiting[command_class] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            return await self.shed(command, command_class, handler, event, data)
+        finally:
+            self.waiting[command_class] -= 1
+
+        wait = time.monotonic() - started
+        stats['admitted'] += 1
+        stats['wait_total'] += wait
+        stats['wait_max'] = max(stats['wait_max'], wait)
+
+        try:
+            return await handler(event, data)
+        finally:
+            semaphore.release()
+
+    async def shed(self, command, command_class, handler, event, data):
+        if command in self.degradable:
+            self.stats[command_class]['degraded'] += 1
+            return await handler(event, {**data, 'degraded': True})
+
+        self.stats[command_class]['shed'] += 1
+        await event.reply('Бот сейчас перегружен. Попробуйте еще раз через минуту')
+
+    def log_stats(self) -> None:
+        for command_class, stats in self.stats.items():
+            if not stats:
+                continue
+
+            log('info', 'Admission {}: admitted {}, shed {}, degraded {}, avg wait {:.3f} s, max wait {:.3f} s',
+                command_class, stats['admitted'], stats['shed'], stats['degraded'],
+                stats['wait_total'] / stats['admitted'] if stats['admitted'] else 0, stats['wait_max'])
+            stats.clear()
+
+admission = AdmissionMiddleware(admission_limits, admission_commands, degradable_commands,
+                                admission_wait_timeout)
+
+dp.message.outer_middleware(ActivityMiddleware())
+dp.callback_query.outer_middleware(ActivityMiddleware())
 dp.message.middleware(CounterMiddleware())
+dp.message.middleware(admission)
 
 
 @dp.message(Command("start"))
@@ -86,6 +226,9 @@ async def start(message: Message):
 /log_food 🍔 - Записать съеденную еду
 /log_workout 🏃‍♂️ - Записать тренировку
 /check_progress 📊 - Посмотреть текущий результат
+/history 📈 - Посмотреть динамику за 7 или 30 дней
+/export 📤 - Выгрузить свои данные в csv или parquet
+/top 🏆 - Рейтинг пользователей за день или неделю
     """
     
     await message.reply(text)
@@ -103,6 +246,9 @@ async def help(message: Message):
 /log_food 🍔 - Записать съеденную еду
 /log_workout 🏃‍♂️ - Записать тренировку
 /check_progress 📊 - Посмотреть текущий результат
+/history 📈 - Посмотреть динамику за 7 или 30 дней
+/export 📤 - Выгрузить свои данные в csv или parquet
+/top 🏆 - Рейтинг пользователей за день или неделю
     """
 
     await message.reply(text)
@@ -114,6 +260,13 @@ async def delete_profile(message: Message, state: FSMContext):
 
     if user_id in users:
         del users[user_id]
+        changed_users.discard(user_id)
+        pending_entries.pop(user_id, None)
+        async with save_lock:
+            await asyncio.to_thread(delete_archived_profile, user_id)
+        users_without_profile.add(user_id)
+        drop_history_cache(user_id)
+        drop_scores(user_id)
         log('info', 'Profile deleted for user {}', user_id)
         await message.reply('Профиль был удален')
     else:
@@ -269,6 +422,8 @@ async def process_city(message: Message, state: FSMContext):
 
     user_data = await state.get_data()
     users[user_id] = {**user_data}
+    users_without_profile.discard(user_id)
+    changed_users.add(user_id)
     
     water_goal, calorie_goal, fat_goal, protein_goal, carbohydrates_goal = calculate_requirements(
         user_data['weight'], user_data['height'], user_data['age'],
@@ -302,6 +457,8 @@ async def log_water(message: Message):
             return
             
         users[user_id]['logged_water'] = users.get(user_id, {}).get('logged_water', 0) + amount
+        entry = add_entry(user_id, type='water', water=amount)
+        add_scores(message.from_user, entry)
         remaining = users[user_id]['water_goal'] - users[user_id]['logged_water']
 
         if remaining > 0:
@@ -354,6 +511,8 @@ async def log_food(message: Message):
         users[user_id]['logged_fat'] = users.get(user_id, {}).get('logged_fat', 0) + fat_per_size
         users[user_id]['logged_protein'] = users.get(user_id, {}).get('logged_protein', 0) + protein_per_size
         users[user_id]['logged_carbohydrates'] = users.get(user_id, {}).get('logged_carbohydrates', 0) + carbohydrates_per_size
+        add_entry(user_id, type='food', name=food_name, grams=food_gram, calories=calories_per_size,
+                  fat=fat_per_size, protein=protein_per_size, carbohydrates=carbohydrates_per_size)
         
         remaining = users[user_id]['calorie_goal'] - users[user_id]['logged_calories']
 
@@ -461,6 +620,9 @@ async def process_duration(message: Message, state: FSMContext):
         
         users[user_id]['burned_calories'] = users.get(user_id, {}).get('burned_calories', 0) + calories_burned
         users[user_id]['trained_time'] = users.get(user_id, {}).get('trained_time', 0) + training_min
+        entry = add_entry(user_id, type='workout', name=workout_type, duration=training_min,
+                          burned_calories=calories_burned)
+        add_scores(message.from_user, entry)
 
         training_extra_time = users[user_id]['trained_time'] - users[user_id]['activity']
         text = f"{workout_type} {training_min} минут — {calories_burned} ккал"
@@ -481,7 +643,7 @@ async def process_duration(message: Message, state: FSMContext):
 
 
 @dp.message(Command('check_progress'))
-async def check_progress(message: Message):
+async def check_progress(message: Message, degraded: bool = False):
     user_id = message.from_user.id
     
     if user_id in users:
@@ -509,9 +671,14 @@ async def check_progress(message: Message):
                         f"\n- Белки: {user_progress.get('logged_protein', 0)} г из {user_progress.get('protein_goal', 0)} г"
                         f"\n- Жиры: {user_progress.get('logged_fat', 0)} г из {user_progress.get('fat_goal', 0)} г"
                         f"\n- Углеводы: {user_progress.get('logged_carbohydrates', 0)} г из {user_progress.get('carbohydrates_goal', 0)} г")
+        if degraded:
+            # overloaded: the text is enough, the chart can be requested later
+            await message.reply(progress_msg + "\n\nГрафик временно недоступен")
+            return
+
         await message.reply(progress_msg)
     
-        create_progress_chart(user_id, users[user_id])
+        await render(create_progress_chart, user_id, users[user_id])
 
         await message.answer_photo(
             FSInputFile(path=f'plots/{user_id}_progress.png')
@@ -521,6 +688,305 @@ async def check_progress(message: Message):
         await message.reply('Профиль не создан. Для начала создайте профиль с помощью команды /set_profile')
 
 
+@dp.message(Command('history'))
+async def history(message: Message):
+    user_id = message.from_user.id
+
+    if user_id not in users:
+        await message.reply('Профиль не создан. Для начала создайте профиль с помощью команды /set_profile')
+        return
+
+    days = message.text.replace('/history', '').strip() or '7'
+
+    if not days.isdigit() or int(days) not in history_days:
+        await message.reply("Используйте: /history <7 или 30>")
+        return
+
+    days = int(days)
+
+    user_data = users[user_id]
+    entries = user_data.get('entries', [])
+    today = int(time.time() // 86400)
+
+    # old entries are trimmed from the list, but the newest one changes on every new entry
+    last_ts = entries[-1]['ts'] if entries else None
+
+    cached = history_cache.get((user_id, days))
+    if cached and cached[:2] == (today, last_ts):
+        await message.reply(cached[2])
+        await message.answer_photo(cached[3])
+        return
+
+    history_data = aggregate_history(entries, days)
+    average = history_data.mean().round().astype(int)
+
+    text = (f"📈 В среднем за {days} дней:\n\n"
+            f"💧 Вода: {average['water']} мл из {user_data['water_goal']} мл\n"
+            f"🔥 Калории: {average['calories']} ккал из {user_data['calorie_goal']} ккал, "
+            f"сожжено {average['burned_calories']} ккал\n"
+            f"🏃‍♂️ Тренировки: {average['duration']} мин из {user_data.get('activity', 0)} мин\n"
+            f"🥗 БЖУ: {average['protein']} / {average['fat']} / {average['carbohydrates']} г "
+            f"из {user_data.get('protein_goal', 0)} / {user_data.get('fat_goal', 0)} / "
+            f"{user_data.get('carbohydrates_goal', 0)} г")
+    await message.reply(text)
+
+    path = await render(create_history_chart, user_id, history_data, user_data)
+    sent = await message.answer_photo(FSInputFile(path=path))
+
+    history_cache[(user_id, days)] = (today, last_ts, text, sent.photo[-1].file_id)
+
+
+@dp.message(Command('export'))
+async def export(message: Message):
+    user_id = message.from_user.id
+
+    if user_id not in users:
+        await message.reply('Профиль не создан. Для начала создайте профиль с помощью команды /set_profile')
+        return
+
+    file_format = message.text.replace('/export', '').strip().lower() or 'csv'
+
+    if file_format not in ('csv', 'parquet'):
+        await message.reply("Используйте: /export <csv или parquet>")
+        return
+
+    export_dir = 'exports'
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    # entries are streamed from the saved entry log, so unsaved ones are written first
+    await save_changed_profiles([user_id])
+    profile = {key: value for key, value in users.get(user_id, {}).items() if key != 'entries'}
+
+    with tempfile.NamedTemporaryFile(dir=export_dir, suffix=f'.{file_format}', delete=False) as f:
+        path = f.name
+
+    try:
+        # entries appended after the size is taken are not exported, so the log is read without the lock
+        async with save_lock:
+            size = await asyncio.to_thread(archived_entries_size, user_id)
+
+        entries = iter_archived_entries(user_id, size=size)
+        rows = await asyncio.to_thread(write_rows, iter_user_records(user_id, profile, entries),
+                                       EXPORT_FIELDS, path, file_format)
+        log('info', 'Exported {} rows for user {}', rows, user_id)
+
+        await message.answer_document(FSInputFile(path=path, filename=f'activity_bot.{file_format}'))
+    finally:
+        os.remove(path)
+
+
+@dp.message(Command('top'))
+async def top(message: Message):
+    user_id = message.from_user.id
+    titles = {'water': '💧 Вода, % от дневной цели',
+              'calories': '🔥 Сожжено, ккал',
+              'time': '🏃‍♂️ Тренировки, мин'}
+    windows = {'day': 'сегодня', 'week': 'эту неделю'}
+
+    args = message.text.replace('/top', '').split()
+    metric = args[0] if len(args) > 0 else 'water'
+    window = args[1] if len(args) > 1 else 'week'
+
+    if metric not in titles or window not in windows:
+        await message.reply("Используйте: /top <water, calories или time> <day или week>")
+        return
+
+    board = leaderboards[metric].board(window)
+    days_elapsed = leaderboards[metric].days_elapsed(window)
+
+    def format_score(score):
+        # weekly water is the average percent of the daily goal over the days passed so far
+        return round(score / days_elapsed) if metric == 'water' else round(score)
+
+    text = f"🏆 Топ за {windows[window]}\n{titles[metric]}\n\n"
+
+    leaders = board.top(10)
+    if not leaders:
+        text += "Пока никто ничего не записал"
+
+    for place, (member, score) in enumerate(leaders, start=1):
+        text += f"{place}. {leaderboard_names.get(member, member)} — {format_score(score)}\n"
+
+    user_rank = board.rank(user_id)
+    if user_rank:
+        text += f"\nВаше место: {user_rank[0]} из {len(board)} ({format_score(user_rank[1])})"
+
+    await message.reply(text)
+
+
+def add_entry(user_id, **entry):
+    entry = {'ts': time.time(), **entry}
+    entries = users[user_id].setdefault('entries', [])
+    entries.append(entry)
+    pending_entries.setdefault(user_id, []).append(entry)
+    changed_users.add(user_id)
+
+    # older entries stay only in the archived entry log
+    expired = bisect_left(entries, history_start(max(history_days)), key=lambda item: item['ts'])
+    if expired:
+        del entries[:expired]
+
+    return entry
+
+
+def score_entry(user_id, entry, water_goal, water_day_points):
+    """
+    Add a logged entry to the leaderboards, returns the water points it gave
+    """
+
+    if entry['type'] == 'water':
+        # a day counts at most 100% of the water goal, poured out water is not subtracted
+        points = min(entry['water'] * 100 / water_goal, 100 - water_day_points)
+
+        if points <= 0:
+            return 0
+
+        leaderboards['water'].add(user_id, points, entry['ts'])
+        return points
+
+    if entry['type'] == 'workout':
+        leaderboards['calories'].add(user_id, entry['burned_calories'], entry['ts'])
+        leaderboards['time'].add(user_id, entry['duration'], entry['ts'])
+
+    return 0
+
+
+def add_scores(user, entry):
+    user_data = users[user.id]
+    # saved with the profile so that names survive the rebuild after restart
+    user_data['first_name'] = leaderboard_names[user.id] = user.first_name
+
+    water_today = leaderboards['water'].board('day').scores.get(user.id, 0)
+    score_entry(user.id, entry, user_data['water_goal'], water_today)
+
+
+async def rebuild_leaderboards():
+    """
+    Replay this week's archived entries, the leaderboards themselves live only in memory
+    """
+
+    started = time.time()
+    week_start = leaderboards['water'].start('week')
+    profiles = iter_archived_profiles(week_start)
+    rebuilt = 0
+
+    # profiles are read in a worker thread a batch at a time
+    while batch := await asyncio.to_thread(lambda: list(islice(profiles, 100))):
+        for user_id, user_data in batch:
+            leaderboard_names.setdefault(user_id, user_data.get('first_name', user_id))
+            water_day_points = {}
+
+            for entry in user_data['entries']:
+                # entries logged after the start are already on the boards
+                if entry['ts'] >= started:
+                    break
+
+                day = int(entry['ts'] // 86400)
+                water_day_points[day] = water_day_points.get(day, 0) + score_entry(
+                    user_id, entry, user_data['water_goal'], water_day_points.get(day, 0))
+
+        rebuilt += len(batch)
+
+    log('info', 'Leaderboards rebuilt from {} profiles', rebuilt)
+
+
+def drop_scores(user_id):
+    leaderboard_names.pop(user_id, None)
+    for board in leaderboards.values():
+        board.remove(user_id)
+
+
+def prune_leaderboard_names():
+    ranked_users = set()
+    for board in leaderboards.values():
+        for window in board.windows:
+            ranked_users.update(board.board(window).scores)
+
+    for user_id in [user_id for user_id in leaderboard_names
+                    if user_id not in users and user_id not in ranked_users]:
+        del leaderboard_names[user_id]
+
+
+def drop_history_cache(user_id):
+    for days in history_days:
+        history_cache.pop((user_id, days), None)
+
+
+async def save_changed_profiles(user_ids=None):
+    """
+    Write changed profiles and their new entries to the archive in a worker thread
+    """
+
+    async with save_lock:
+        to_save = list(changed_users if user_ids is None else changed_users.intersection(user_ids))
+        changed_users.difference_update(to_save)
+
+        # the snapshot is taken on the event loop, handlers may change users while it is written
+        profiles = [(user_id,
+                     {key: value for key, value in users[user_id].items() if key != 'entries'},
+                     pending_entries.pop(user_id, []))
+                    for user_id in to_save if user_id in users]
+
+        await asyncio.to_thread(archive_profiles, profiles)
+
+    return len(profiles)
+
+
+async def evict_inactive():
+    while True:
+        await asyncio.sleep(eviction_interval)
+
+        evicted_states = storage.evict_idle()
+        saved_profiles = await save_changed_profiles()
+
+        deadline = time.monotonic() - profile_ttl
+        inactive_users = [user_id for user_id, seen in last_seen.items() if seen < deadline]
+
+        for user_id in inactive_users:
+            if user_id in changed_users:
+                # changed while the profiles were being saved, evicted on the next run
+                continue
+
+            del last_seen[user_id]
+            users_without_profile.discard(user_id)
+            # the profile is already on disk after save_changed_profiles
+            users.pop(user_id, None)
+            drop_history_cache(user_id)
+
+        # scores of evicted users stay on the boards until the period ends
+        prune_leaderboard_names()
+
+        log('info', 'Evicted {} idle FSM contexts, saved {} profiles, archived {} inactive users',
+            evicted_states, saved_profiles, len(inactive_users))
+
+
+async def report_admission_stats():
+    while True:
+        await asyncio.sleep(admission_stats_interval)
+        admission.log_stats()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+@dp.startup()
+async def on_startup():
+    # heavy modules are loaded in a worker thread while polling is already running
+    run_in_background(asyncio.to_thread(preload_modules))
+    run_in_background(evict_inactive())
+    run_in_background(rebuild_leaderboards())
+    run_in_background(report_admission_stats())
+
+
+@dp.shutdown()
+async def on_shutdown():
+    log('info', 'Saved {} profiles on shutdown', await save_changed_profiles())
+
+
 async def main():
     print("Бот запущен!")
     await dp.start_polling(bot)
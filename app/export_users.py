@@ -0,0 +1,77 @@
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+
+from utils import iter_user_records, write_rows, EXPORT_FIELDS
+from storage import iter_archived_entries
+
+
+def profile_paths(archive_dir: str) -> List[str]:
+    # entry logs (<user_id>.entries.jsonl) are read together with their profile
+    return sorted(os.path.join(archive_dir, file_name) for file_name in os.listdir(archive_dir)
+                  if file_name.endswith('.json'))
+
+def iter_records(paths: List[str], archive_dir: str) -> Iterator[Tuple]:
+    """
+    Records of the profiles one file at a time
+    """
+
+    for path in paths:
+        user_id = int(os.path.basename(path)[:-len('.json')])
+
+        try:
+            with open(path, encoding='utf-8') as f:
+                user_data = json.load(f)
+        except FileNotFoundError:
+            # the profile was deleted after the directory was listed
+            continue
+
+        yield from iter_user_records(user_id, user_data, iter_archived_entries(user_id, archive_dir))
+
+def export_part(paths: List[str], archive_dir: str, path: str, file_format: str, chunk_size: int) -> int:
+    return write_rows(iter_records(paths, archive_dir), EXPORT_FIELDS, path, file_format, chunk_size)
+
+def lower_priority(niceness: int) -> None:
+    # workers should not take CPU from the running bot
+    os.nice(niceness)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export all saved profiles and their entries')
+    parser.add_argument('--archive-dir', default='archive')
+    parser.add_argument('--output-dir', default='exports')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='parquet')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows written at once')
+    parser.add_argument('--niceness', type=int, default=10, help='priority decrease of the workers')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.archive_dir):
+        parser.error(f'archive directory not found: {args.archive_dir}')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    paths = profile_paths(args.archive_dir)
+    parts = [paths[i::args.workers] for i in range(args.workers) if paths[i::args.workers]]
+
+    with ProcessPoolExecutor(max_workers=len(parts) or 1, initializer=lower_priority,
+                             initargs=(args.niceness,)) as executor:
+        futures = []
+        for i, part_paths in enumerate(parts):
+            part_path = os.path.join(args.output_dir, f'part-{i:05d}.{args.format}')
+            futures.append((part_path, executor.submit(export_part, part_paths, args.archive_dir, part_path,
+                                                       args.format, args.chunk_size)))
+
+        for part_path, future in futures:
+            print(f'Saved {future.result()} rows to {part_path}')
+
+    print(f'Exported {len(paths)} profiles')
+
+
+if __name__ == "__main__":
+    main()
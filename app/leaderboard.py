@@ -0,0 +1,104 @@
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, Hashable, List, Tuple, Union
+
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    """
+    Scores accumulated per member, ranked from the highest
+    """
+
+    def __init__(self) -> None:
+        self.scores: Dict[Hashable, float] = {}
+        # ties are ordered by member so every key is unique
+        self.ranking = SortedList()
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def add(self, member: Hashable, amount: float) -> None:
+        score = self.scores.get(member)
+
+        if score is not None:
+            self.ranking.remove((-score, member))
+
+        score = (score or 0) + amount
+        self.scores[member] = score
+        self.ranking.add((-score, member))
+
+    def remove(self, member: Hashable) -> None:
+        score = self.scores.pop(member, None)
+
+        if score is not None:
+            self.ranking.remove((-score, member))
+
+    def rank(self, member: Hashable) -> Union[Tuple[int, float], None]:
+        """
+        One-based place and score of member
+        """
+
+        score = self.scores.get(member)
+
+        if score is None:
+            return None
+
+        return (self.ranking.index((-score, member)) + 1, score)
+
+    def top(self, count: int) -> List[Tuple[Hashable, float]]:
+        return [(member, -score) for score, member in self.ranking.islice(0, count)]
+
+
+class WindowedLeaderboard:
+    """
+    Daily and weekly leaderboards (UTC), a new period starts with an empty board
+    """
+
+    # first day of the period that contains the day
+    windows = {
+        'day': lambda day: day,
+        'week': lambda day: day - timedelta(days=day.weekday()),
+    }
+
+    def __init__(self) -> None:
+        self.periods: Dict[str, date] = {}
+        self.boards: Dict[str, Leaderboard] = {}
+
+    def board(self, window: str) -> Leaderboard:
+        period = self.windows[window](today())
+
+        if self.periods.get(window) != period:
+            self.periods[window] = period
+            self.boards[window] = Leaderboard()
+
+        return self.boards[window]
+
+    def start(self, window: str) -> float:
+        """
+        Timestamp of the beginning of the current period
+        """
+
+        period = self.windows[window](today())
+        return datetime.combine(period, time.min, tzinfo=timezone.utc).timestamp()
+
+    def days_elapsed(self, window: str) -> int:
+        return (today() - self.windows[window](today())).days + 1
+
+    def add(self, member: Hashable, amount: float, ts: float) -> None:
+        """
+        Add amount logged at ts to the boards of the current periods that contain ts
+        """
+
+        day = datetime.fromtimestamp(ts, timezone.utc).date()
+
+        for window, period in self.windows.items():
+            if period(day) == period(today()):
+                self.board(window).add(member, amount)
+
+    def remove(self, member: Hashable) -> None:
+        for window in self.windows:
+            self.board(window).remove(member)
+
+
+def today() -> date:
+    return datetime.now(timezone.utc).date()
@@ -0,0 +1,191 @@
+import os
+import re
+import argparse
+from collections import Counter, defaultdict
+from typing import Iterator, List, Tuple
+
+from utils import write_rows
+
+
+LINE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2}) [\d:,]+ - (\w+) - (.*)$')
+USER_MESSAGE_PATTERN = re.compile(r'^User: (\d+)\. Message: (.*)$')
+# written by bot.AdmissionMiddleware.log_stats
+ADMISSION_PATTERN = re.compile(r'^Admission (\w+): admitted (\d+), shed (\d+), degraded (\d+), '
+                               r'avg wait ([\d.]+) s, max wait ([\d.]+) s$')
+
+# (success, failure) message prefixes written by utils.get_coordinates and utils.get_food_info
+API_PATTERNS = {
+    'geocoding': ('Coordinates received for', 'Geocoding error'),
+    'nutrition': ('Api successful request.', 'Nutrition request error'),
+}
+FOOD_MISS_PREFIX = 'No data was found for '
+TRANSLATION_MISS_PREFIX = 'Failed to translate '
+
+
+def log_files(log_dir: str, log_name: str = 'log_file.log') -> List[str]:
+    """
+    Current and rotated log files, oldest first
+    """
+
+    base_path = os.path.join(log_dir, log_name)
+    rotated = []
+
+    for file_name in os.listdir(log_dir):
+        suffix = file_name[len(log_name) + 1:]
+        if file_name.startswith(log_name + '.') and suffix.isdigit():
+            rotated.append((int(suffix), os.path.join(log_dir, file_name)))
+
+    paths = [path for _, path in sorted(rotated, reverse=True)]
+    if os.path.isfile(base_path):
+        paths.append(base_path)
+
+    return paths
+
+def read_lines(paths: List[str]) -> Iterator[str]:
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            yield from f
+
+def parse_records(lines: Iterator[str]) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yield (day, level, message). Continuation lines of multiline messages are skipped
+    """
+
+    for line in lines:
+        match = LINE_PATTERN.match(line.rstrip('\n'))
+        if match:
+            yield match.groups()
+
+
+class LogStats:
+    def __init__(self) -> None:
+        self.commands = Counter()
+        self.daily_messages = Counter()
+        self.daily_users = defaultdict(set)
+        self.api_requests = Counter()
+        self.api_errors = Counter()
+        self.food_misses = Counter()
+        self.translation_misses = 0
+        self.errors = 0
+        self.admission = defaultdict(Counter)
+
+    def update(self, day: str, level: str, message: str) -> None:
+        user_message = USER_MESSAGE_PATTERN.match(message)
+
+        if user_message:
+            user_id, text = user_message.groups()
+            self.commands[command_name(text)] += 1
+            self.daily_messages[day] += 1
+            self.daily_users[day].add(int(user_id))
+            return
+
+        admission = ADMISSION_PATTERN.match(message)
+
+        if admission:
+            command_class, admitted, shed, degraded, avg_wait, max_wait = admission.groups()
+            stats = self.admission[command_class]
+            stats['admitted'] += int(admitted)
+            stats['shed'] += int(shed)
+            stats['degraded'] += int(degraded)
+            stats['wait_total'] += int(admitted) * float(avg_wait)
+            stats['wait_max'] = max(stats['wait_max'], float(max_wait))
+            return
+
+        for api, (success_prefix, error_prefix) in API_PATTERNS.items():
+            if message.startswith(success_prefix):
+                self.api_requests[api] += 1
+                return
+            if message.startswith(error_prefix):
+                self.api_requests[api] += 1
+                self.api_errors[api] += 1
+                return
+
+        if level == 'ERROR':
+            self.errors += 1
+        elif message.startswith(FOOD_MISS_PREFIX):
+            self.food_misses[message[len(FOOD_MISS_PREFIX):].strip().lower()] += 1
+        elif message.startswith(TRANSLATION_MISS_PREFIX):
+            self.translation_misses += 1
+
+    def tables(self) -> dict:
+        """
+        Statistics as {name: (fields, rows)}
+        """
+
+        api_rows = [(api, requests, self.api_errors[api], round(self.api_errors[api] / requests, 4))
+                    for api, requests in sorted(self.api_requests.items())]
+
+        admission_rows = []
+        for command_class, stats in sorted(self.admission.items()):
+            requests = stats['admitted'] + stats['shed'] + stats['degraded']
+            admission_rows.append((command_class, stats['admitted'], stats['shed'], stats['degraded'],
+                                   round((stats['shed'] + stats['degraded']) / requests, 4) if requests else 0.0,
+                                   round(stats['wait_total'] / stats['admitted'], 3) if stats['admitted'] else 0.0,
+                                   round(stats['wait_max'], 3)))
+
+        return {
+            'commands': ([('command', 'str'), ('messages', 'int')],
+                         self.commands.most_common()),
+            'daily_users': ([('day', 'str'), ('active_users', 'int'), ('messages', 'int')],
+                            [(day, len(self.daily_users[day]), self.daily_messages[day])
+                             for day in sorted(self.daily_users)]),
+            'api_errors': ([('api', 'str'), ('requests', 'int'), ('errors', 'int'), ('error_rate', 'float')],
+                           api_rows),
+            'food_misses': ([('food', 'str'), ('misses', 'int')],
+                            self.food_misses.most_common()),
+            'admission': ([('command_class', 'str'), ('admitted', 'int'), ('shed', 'int'), ('degraded', 'int'),
+                           ('overload_rate', 'float'), ('avg_wait', 'float'), ('max_wait', 'float')],
+                          admission_rows),
+        }
+
+
+def command_name(text: str) -> str:
+    if not text.startswith('/'):
+        return 'text'
+    return text.split()[0].split('@')[0]
+
+def collect_stats(log_dir: str) -> LogStats:
+    stats = LogStats()
+
+    for day, level, message in parse_records(read_lines(log_files(log_dir))):
+        stats.update(day, level, message)
+
+    return stats
+
+def print_tables(stats: LogStats, top: int) -> None:
+    for name, (fields, rows) in stats.tables().items():
+        print(f'\n{name}')
+        print('\t'.join(field for field, _ in fields))
+        for row in rows[:top]:
+            print('\t'.join(str(value) for value in row))
+
+    print(f'\ntranslation misses\t{stats.translation_misses}')
+    print(f'errors\t{stats.errors}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Usage statistics from the current and rotated bot logs')
+    parser.add_argument('--log-dir', default='logs')
+    parser.add_argument('--top', type=int, default=20, help='rows of each table to print')
+    parser.add_argument('--output-dir', help='also save every table to this directory')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.log_dir):
+        parser.error(f'log directory not found: {args.log_dir}')
+
+    stats = collect_stats(args.log_dir)
+    print_tables(stats, args.top)
+
+    if args.output_dir:
+        if not os.path.exists(args.output_dir):
+            os.makedirs(args.output_dir)
+
+        for name, (fields, rows) in stats.tables().items():
+            path = os.path.join(args.output_dir, f'{name}.{args.format}')
+            write_rows(rows, fields, path, args.format)
+            print(f'Saved {path}')
+
+
+if __name__ == "__main__":
+    main()
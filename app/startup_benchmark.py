@@ -0,0 +1,70 @@
+import os
+import sys
+import argparse
+import subprocess
+from typing import List, Tuple
+
+
+def import_time_breakdown(module: str, top: int) -> Tuple[int, List[Tuple[int, int, str]]]:
+    """
+    Import module with -X importtime and return total time and the slowest imports
+    """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=benchmark_env())
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+
+    total = next((cumulative for _, cumulative, name in rows if name.strip() == module), 0)
+    rows.sort(key=lambda row: row[1], reverse=True)
+
+    return (total, rows[:top])
+
+def idle_memory(module: str, preload: bool) -> int:
+    """
+    Peak RSS in KB of a process that imported module
+    """
+
+    code = f'import resource, {module}\n'
+    if preload:
+        code += 'import utils\nutils.preload_modules()\n'
+    code += 'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)'
+
+    result = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True, text=True, env=benchmark_env())
+
+    return int(result.stdout.strip().splitlines()[-1])
+
+def benchmark_env() -> dict:
+    # bot.py creates the Bot at import time, which requires a well-formed token
+    env = dict(os.environ)
+    env.setdefault('ACTIVITY_BOT_TOKEN', '123456:benchmark')
+
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time and idle memory of the bot modules')
+    parser.add_argument('modules', nargs='*', default=['utils', 'bot'])
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        total, rows = import_time_breakdown(module, args.top)
+
+        print(f'{module}: {total / 1000:.0f} ms')
+        print(f'{"self, ms":>10} {"cumulative, ms":>15}  module')
+        for self_us, cumulative_us, name in rows:
+            print(f'{self_us / 1000:>10.1f} {cumulative_us / 1000:>15.1f}  {name}')
+
+        print(f'Idle memory: {idle_memory(module, False) / 1024:.1f} MB, '
+              f'after preload: {idle_memory(module, True) / 1024:.1f} MB\n')
+
+
+if __name__ == "__main__":
+    main()
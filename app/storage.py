@@ -0,0 +1,164 @@
+import os
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+
+class TTLMemoryStorage(MemoryStorage):
+    """
+    In-memory FSM storage that forgets contexts idle for longer than ttl seconds
+    """
+
+    def __init__(self, ttl: int) -> None:
+        super().__init__()
+        self.ttl = ttl
+        self.last_access: Dict[StorageKey, float] = {}
+
+    async def set_state(self, key: StorageKey, state: Union[State, str, None] = None) -> None:
+        self.last_access[key] = time.monotonic()
+        await super().set_state(key, state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        self.last_access[key] = time.monotonic()
+        return await super().get_state(key)
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        self.last_access[key] = time.monotonic()
+        await super().set_data(key, data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        self.last_access[key] = time.monotonic()
+        return await super().get_data(key)
+
+    async def get_value(self, storage_key: StorageKey, dict_key: str, default: Optional[Any] = None) -> Optional[Any]:
+        self.last_access[storage_key] = time.monotonic()
+        return await super().get_value(storage_key, dict_key, default)
+
+    def evict_idle(self) -> int:
+        """
+        Remove contexts that were not accessed during ttl
+        """
+
+        deadline = time.monotonic() - self.ttl
+        idle_keys = [key for key, accessed in self.last_access.items() if accessed < deadline]
+
+        for key in idle_keys:
+            del self.last_access[key]
+            self.storage.pop(key, None)
+
+        return len(idle_keys)
+
+
+def profile_path(user_id: int, archive_dir: str) -> str:
+    return os.path.join(archive_dir, f'{user_id}.json')
+
+def entries_path(user_id: int, archive_dir: str) -> str:
+    return os.path.join(archive_dir, f'{user_id}.entries.jsonl')
+
+def archive_profile(user_id: int, user_data: Dict, new_entries: List[Dict],
+                    archive_dir: str = 'archive') -> None:
+    """
+    Save user profile to cold storage, replacing the previous copy, and append
+    new entries to the user's entry log. user_data is saved without entries
+    """
+
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+
+    path = profile_path(user_id, archive_dir)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(user_data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+    if new_entries:
+        with open(entries_path(user_id, archive_dir), 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + '\n' for entry in new_entries)
+
+def archive_profiles(profiles: List[Tuple[int, Dict, List[Dict]]], archive_dir: str = 'archive') -> None:
+    for user_id, user_data, new_entries in profiles:
+        archive_profile(user_id, user_data, new_entries, archive_dir)
+
+def archived_entries_size(user_id: int, archive_dir: str = 'archive') -> int:
+    try:
+        return os.path.getsize(entries_path(user_id, archive_dir))
+    except FileNotFoundError:
+        return 0
+
+def iter_archived_entries(user_id: int, archive_dir: str = 'archive',
+                          size: Optional[int] = None) -> Iterator[Dict]:
+    """
+    Entries of the user's log, oldest first. With size only the first size bytes are read
+    """
+
+    try:
+        f = open(entries_path(user_id, archive_dir), 'rb')
+    except FileNotFoundError:
+        return
+
+    read = 0
+
+    with f:
+        for line in f:
+            read += len(line)
+
+            if size is not None and read > size:
+                break
+
+            # the last line may still be being appended by the bot
+            if line.endswith(b'\n'):
+                yield json.loads(line)
+
+def restore_profile(user_id: int, since: float = 0, archive_dir: str = 'archive') -> Union[Dict, None]:
+    """
+    Load user profile and its entries logged since the given timestamp from cold storage
+    """
+
+    path = profile_path(user_id, archive_dir)
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, encoding='utf-8') as f:
+        user_data = json.load(f)
+    user_data['entries'] = [entry for entry in iter_archived_entries(user_id, archive_dir)
+                            if entry['ts'] >= since]
+
+    return user_data
+
+def iter_archived_profiles(since: float = 0, archive_dir: str = 'archive') -> Iterator[Tuple[int, Dict]]:
+    """
+    Saved profiles that logged entries since the given timestamp, with those entries
+    """
+
+    if not os.path.isdir(archive_dir):
+        return
+
+    with os.scandir(archive_dir) as files:
+        for file in files:
+            if not file.name.endswith('.json'):
+                continue
+
+            user_id = int(file.name[:-len('.json')])
+
+            # the entry log is only appended to, so an older file has nothing to read
+            try:
+                if os.path.getmtime(entries_path(user_id, archive_dir)) < since:
+                    continue
+            except FileNotFoundError:
+                continue
+
+            user_data = restore_profile(user_id, since, archive_dir)
+
+            if user_data is not None:
+                yield (user_id, user_data)
+
+def delete_archived_profile(user_id: int, archive_dir: str = 'archive') -> None:
+    for path in (profile_path(user_id, archive_dir), entries_path(user_id, archive_dir)):
+        if os.path.isfile(path):
+            os.remove(path)
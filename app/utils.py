@@ -1,17 +1,34 @@
 import os
+import csv
+import time
+import asyncio
 import logging
+from bisect import bisect_left
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
-from typing import Tuple, Dict, Union
+from typing import Tuple, Dict, Union, Iterable, List, Sequence, Callable, Any
 
 import requests
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
-import matplotlib.pyplot as plt
-from googletrans import Translator
 import aiohttp
 
+# openmeteo_requests, requests_cache, retry_requests, matplotlib, pandas, googletrans and pyarrow
+# are imported inside the functions that use them: they are needed only by
+# rare commands and make up most of the startup time
+
+# pyplot keeps global state, so all charts are drawn one by one in this thread
+render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+
+PROFILE_FIELDS = ['weight', 'height', 'sex', 'age', 'activity', 'calories', 'city']
+GOAL_FIELDS = ['water_goal', 'calorie_goal', 'fat_goal', 'protein_goal', 'carbohydrates_goal']
+TOTAL_FIELDS = ['logged_water', 'additional_water', 'logged_calories', 'logged_fat', 'logged_protein',
+                'logged_carbohydrates', 'burned_calories', 'trained_time']
+# long format: text values go to name, numbers go to value
+EXPORT_FIELDS = [('user_id', 'int'), ('record', 'str'), ('ts', 'float'),
+                 ('name', 'str'), ('field', 'str'), ('value', 'float')]
+
+HISTORY_COLUMNS = ['water', 'calories', 'fat', 'protein', 'carbohydrates', 'duration', 'burned_calories']
+
 
 class ValueOutOfRangeError(Exception):
     def __init__(self, message, value, min_value, max_value):
@@ -46,7 +63,7 @@ def get_coordinates(city: str) -> Union[Tuple[float, float], None]:
             log('info', 'Coordinates for city {} not found', city)
             return None
     else:
-        log('info', 'Error: {}', response.status_code)
+        log('info', 'Geocoding error. Response code: {}', response.status_code)
         return None
 
 def get_weather(city: str) -> Union[float, None]:
@@ -54,6 +71,10 @@ def get_weather(city: str) -> Union[float, None]:
     Get geather by coordinates
     """
 
+    import openmeteo_requests
+    import requests_cache
+    from retry_requests import retry
+
     coord = get_coordinates(city)
     if not coord:
         return None
@@ -75,18 +96,9 @@ def get_weather(city: str) -> Union[float, None]:
     hourly = response.Hourly()
     hourly_temperature_2m = hourly.Variables(0).ValuesAsNumpy()
 
-    if list(hourly_temperature_2m):
-        log('info', 'Max temperature for {} is {}', city, max(hourly_temperature_2m))
-
-        hourly_data = {"date": pd.date_range(
-            start = pd.to_datetime(hourly.Time(), unit = "s", utc = True),
-            end = pd.to_datetime(hourly.TimeEnd(), unit = "s", utc = True),
-            freq = pd.Timedelta(seconds = hourly.Interval()),
-            inclusive = "left"
-        )}
-        hourly_data["temperature_2m"] = hourly_temperature_2m
-        hourly_dataframe = pd.DataFrame(data = hourly_data)
-        max_temp = max(hourly_dataframe['temperature_2m'])
+    if hourly_temperature_2m.size:
+        max_temp = float(hourly_temperature_2m.max())
+        log('info', 'Max temperature for {} is {}', city, max_temp)
 
         return max_temp
     
@@ -149,13 +161,15 @@ async def get_food_info(food_name: str, calories_token: str) -> Dict:
                         log('info', 'No data was found for {}', food_name)
                         return None
                 else:
-                    log('info', 'Api error. Response code: {}',response.status)
+                    log('info', 'Nutrition request error. Response code: {}',response.status)
                     return None
         except Exception as e:
-            log('info', 'Error: {}', e)
+            log('info', 'Nutrition request error: {}', e)
             return None
 
 async def translate_text(food_name: str) -> str:
+    from googletrans import Translator
+
     async with Translator() as translator:
         try:
             result = await translator.translate(food_name)
@@ -170,6 +184,31 @@ async def translate_text(food_name: str) -> str:
         except Exception as e:
             log('info', 'Error: {}', e)
 
+def get_pyplot():
+    """
+    Import pyplot with the non-interactive backend
+    """
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    return plt
+
+def preload_modules() -> None:
+    """
+    Import heavy modules ahead of the first command that needs them
+    """
+
+    get_pyplot()
+    import pandas
+    import googletrans
+    import openmeteo_requests
+    import requests_cache
+    import retry_requests
+
+    log('info', 'Heavy modules preloaded')
+
 def format_func(pct, allvals, performance):
     absolute = int(pct / 100. * sum(allvals))
     performance = performance * 100
@@ -207,6 +246,8 @@ def create_progress_chart(user_id, user_data):
     Create progress plot
     """
 
+    plt = get_pyplot()
+
     plot_dir = 'plots'
     if not os.path.exists(plot_dir):
         os.makedirs(plot_dir)
@@ -249,6 +290,146 @@ def create_progress_chart(user_id, user_data):
     plt.savefig(f'plots/{user_id}_progress.png', format='png')
     plt.close()
 
+async def render(func: Callable, *args) -> Any:
+    """
+    Run chart rendering outside of the event loop
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(render_executor, func, *args)
+
+def history_start(days: int) -> float:
+    """
+    Timestamp of the first second of the last days (UTC)
+    """
+
+    return (int(time.time() // 86400) - days + 1) * 86400
+
+def aggregate_history(entries: List[Dict], days: int):
+    """
+    Daily sums of logged entries for the last days (UTC), days without entries are zeros
+    """
+
+    import pandas as pd
+
+    today = int(time.time() // 86400)
+    first_day = today - days + 1
+
+    # entries are appended in time order, so the window is a tail of the list
+    start = bisect_left(entries, history_start(days), key=lambda entry: entry['ts'])
+    history = pd.DataFrame.from_records(entries[start:], columns=['ts', *HISTORY_COLUMNS]).astype('float64')
+
+    history['day'] = (history['ts'] // 86400).astype('int64')
+    history = (history.drop(columns='ts')
+                      .groupby('day').sum()
+                      .reindex(range(first_day, today + 1), fill_value=0))
+    history.index = pd.to_datetime(history.index, unit='D')
+
+    return history
+
+def create_history_chart(user_id, history, user_data):
+    """
+    Create trend plot for the aggregated history
+    """
+
+    plt = get_pyplot()
+
+    plot_dir = 'plots'
+    if not os.path.exists(plot_dir):
+        os.makedirs(plot_dir)
+
+    days = history.index.strftime('%d.%m')
+    fig, axes = plt.subplots(2, 2, figsize=(12, 8))
+
+    axes[0][0].bar(days, history['water'], color=(0.95, 0.7, 0.27))
+    axes[0][0].axhline(user_data.get('water_goal', 0), color='gray', linestyle='--')
+    axes[0][0].set_title('Вода, мл.')
+
+    axes[0][1].bar(days, history['calories'], color=(0.86, 0.4, 0.31), label='Потреблено')
+    axes[0][1].bar(days, -history['burned_calories'], color=(0.45, 0.84, 0.52), label='Сожжено')
+    axes[0][1].axhline(user_data.get('calorie_goal', 0), color='gray', linestyle='--')
+    axes[0][1].set_title('Калории, ккал.')
+    axes[0][1].legend()
+
+    for column, label, color in [('protein', 'Белки', 'tab:blue'),
+                                 ('fat', 'Жиры', 'tab:orange'),
+                                 ('carbohydrates', 'Углеводы', 'tab:green')]:
+        axes[1][0].plot(days, history[column], marker='o', color=color, label=label)
+        axes[1][0].axhline(user_data.get(f'{column}_goal', 0), color=color, linestyle='--')
+    axes[1][0].set_title('БЖУ, г.')
+    axes[1][0].legend()
+
+    axes[1][1].bar(days, history['duration'], color=(0.45, 0.84, 0.52))
+    axes[1][1].axhline(user_data.get('activity', 0), color='gray', linestyle='--')
+    axes[1][1].set_title('Тренировки, мин.')
+
+    for ax in axes.flat:
+        ax.tick_params(axis='x', labelrotation=90, labelsize=8)
+
+    plt.tight_layout()
+    path = f'plots/{user_id}_history_{len(history)}.png'
+    plt.savefig(path, format='png')
+    plt.close()
+
+    return path
+
+def iter_user_records(user_id: int, user_data: Dict, entries: Iterable[Dict]) -> Iterable[Tuple]:
+    """
+    Profile, goals, totals and the given entries of the user as EXPORT_FIELDS rows
+    """
+
+    for record, fields in [('profile', PROFILE_FIELDS), ('goal', GOAL_FIELDS), ('total', TOTAL_FIELDS)]:
+        for field in fields:
+            value = user_data.get(field)
+
+            if isinstance(value, str):
+                yield (user_id, record, None, value, field, None)
+            elif value is not None:
+                yield (user_id, record, None, None, field, float(value))
+
+    for entry in entries:
+        for field, value in entry.items():
+            if field not in ('ts', 'type', 'name'):
+                yield (user_id, entry['type'], entry['ts'], entry.get('name'), field, float(value))
+
+def write_rows(rows: Iterable[Sequence], fields: List[Tuple[str, str]], path: str,
+               file_format: str = 'csv', chunk_size: int = 10000) -> int:
+    """
+    Write rows to csv or parquet file chunk by chunk. Fields are (name, type) pairs,
+    type is one of 'int', 'float', 'str'
+    """
+
+    rows = iter(rows)
+    names = [name for name, _ in fields]
+    written = 0
+
+    if file_format == 'csv':
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(names)
+
+            while chunk := list(islice(rows, chunk_size)):
+                writer.writerows(chunk)
+                written += len(chunk)
+
+    elif file_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        types = {'int': pa.int64(), 'float': pa.float64(), 'str': pa.string()}
+        schema = pa.schema([(name, types[field_type]) for name, field_type in fields])
+
+        with pq.ParquetWriter(path, schema) as writer:
+            while chunk := list(islice(rows, chunk_size)):
+                columns = list(zip(*chunk))
+                writer.write_table(pa.table(columns, schema=schema))
+                written += len(chunk)
+
+    else:
+        raise ValueError(f'Unknown file format: {file_format}')
+
+    return written
+
 def setup_logging() -> None:
     '''
     logging settings